@@ -4,10 +4,13 @@
 # content:    Dataset functions to plot gene expression and phenotypes
 # Modules
 import warnings
+import weakref
+import functools
 import numpy as np
 import pandas as pd
 import matplotlib as mpl
 from matplotlib import cm
+from scipy.interpolate import pchip_interpolate as _pchip
 
 from .plugins import Plugin
 from ..config import config
@@ -30,10 +33,120 @@ except (ImportError, RuntimeError):
     plt = None
 
 
+# Pyplot-free Agg figures, reused across calls by plot method and figure size
+_figure_pool = weakref.WeakValueDictionary()
+
+
 # Classes / functions
+@functools.lru_cache(maxsize=64)
+def _get_cmap(name):
+    '''Get a matplotlib colormap by name, caching the lookup'''
+    return cm.get_cmap(name)
+
+
+@functools.lru_cache(maxsize=64)
+def _to_rgba_cached(color, alpha):
+    return mpl.colors.to_rgba(color, alpha=alpha)
+
+
+def _to_rgba(color, alpha=None):
+    '''Convert a color to RGBA, caching the conversion'''
+    if not isinstance(color, str):
+        color = tuple(color)
+    return _to_rgba_cached(color, alpha)
+
+
+def _is_numeric(dtype):
+    '''Whether a dtype is numeric (and not categorical)'''
+    if isinstance(dtype, pd.api.types.CategoricalDtype):
+        return False
+    return dtype.kind in 'iufc'
+
+
+def _sequential_colors(values, cmap):
+    '''Map numeric values onto a colormap, spanning their range
+
+    Returns:
+        (colors, vmin, vmax) with the N x 4 RGBA array and the extremes.
+    '''
+    if np.issubdtype(values.dtype, np.integer):
+        vmin, vmax = values.min(), values.max()
+    else:
+        vmin, vmax = np.nanmin(values), np.nanmax(values)
+    norm = mpl.colors.Normalize(vmin=vmin, vmax=vmax)
+    c = cm.ScalarMappable(norm=norm, cmap=cmap).to_rgba(values)
+    return c, vmin, vmax
+
+
+@functools.lru_cache(maxsize=1)
+def _get_mean_std_numba():
+    '''Compile the fused mean/std kernel on first use
+
+    Returns:
+        the numba kernel, or None if numba is not available.
+    '''
+    try:
+        import numba
+    except ImportError:
+        return None
+
+    @numba.njit(parallel=True, cache=True)
+    def _mean_std_numba(values):
+        '''Mean and standard deviation of each row in a single pass
+
+        Args:
+            values (2D numpy.ndarray): the matrix, e.g. features x samples.
+
+        Returns:
+            a pair of 1D arrays with the mean and the standard deviation
+            (ddof=1, NaNs skipped) of each row.
+        '''
+        n_rows, n_cols = values.shape
+        mean = np.empty(n_rows)
+        std = np.empty(n_rows)
+        for i in numba.prange(n_rows):
+            # Welford's online algorithm
+            n = 0
+            m = 0.0
+            m2 = 0.0
+            for j in range(n_cols):
+                v = values[i, j]
+                if np.isnan(v):
+                    continue
+                n += 1
+                delta = v - m
+                m += delta / n
+                m2 += delta * (v - m)
+            mean[i] = m if n > 0 else np.nan
+            std[i] = np.sqrt(m2 / (n - 1)) if n > 1 else np.nan
+        return mean, std
+
+    return _mean_std_numba
+
+
 class Plot(Plugin):
     '''Plot gene expression and phenotype in single cells'''
 
+    _ALIASES = {
+            'linewidth': 'lw',
+            'antialiased': 'aa',
+            'color': 'c',
+            'linestyle': 'ls',
+            'markeredgecolor': 'mec',
+            'markeredgewidth': 'mew',
+            'markerfacecolor': 'mfc',
+            'markerfacecoloralt': 'mfcalt',
+            'markersize': 'ms',
+            }
+    _ALIAS_SET = frozenset(_ALIASES.values())
+    _ALIAS_REV = {alias: key for key, alias in _ALIASES.items()}
+
+    # Scatter properties that mean the same for a marker-only Line2D
+    _MARKER_LINE_KEYS = frozenset([
+            's', 'color', 'alpha', 'marker', 'label', 'zorder',
+            'rasterized', 'clip_on', 'visible', 'gid', 'url', 'picker',
+            ])
+
     @staticmethod
     def _update_properties(kwargs, defaults):
         Plot._sanitize_plot_properties(kwargs)
@@ -44,28 +157,201 @@ class Plot(Plugin):
 
     @staticmethod
     def _sanitize_plot_properties(kwargs):
-        aliases = {
-                'linewidth': 'lw',
-                'antialiased': 'aa',
-                'color': 'c',
-                'linestyle': 'ls',
-                'markeredgecolor': 'mec',
-                'markeredgewidth': 'mew',
-                'markerfacecolor': 'mfc',
-                'markerfacecoloralt': 'mfcalt',
-                'markersize': 'ms',
-                }
-        for key, alias in aliases.items():
-            if alias in kwargs:
-                kwargs[key] = kwargs.pop(alias)
+        for alias in Plot._ALIAS_SET.intersection(kwargs):
+            kwargs[Plot._ALIAS_REV[alias]] = kwargs.pop(alias)
+
+    @staticmethod
+    def _new_axes(figsize, backend=None, name=None):
+        '''Create a figure with a single axes
+
+        Args:
+            figsize (tuple): The size of the figure.
+            backend (str or None): If None, create the figure via pyplot. \
+                    If 'agg', create a figure with an Agg canvas outside of \
+                    pyplot, for batch export. Such figures are reused by \
+                    later calls with the same name and figsize: their axes \
+                    are cleared instead of creating a new figure, so save \
+                    each plot before making the next one.
+            name (str or None): Name of the calling plot method, so that \
+                    different kinds of plots never share a figure.
+
+        Returns:
+            (fig, ax) with the figure and its axes.
+        '''
+        if backend is None:
+            return plt.subplots(
+                    nrows=1, ncols=1, figsize=figsize,
+                    constrained_layout=True)
+
+        if backend.lower() != 'agg':
+            raise ValueError('Only the "agg" backend is supported')
+
+        key = (name, figsize)
+        fig = _figure_pool.get(key)
+        if fig is not None:
+            ax = fig.axes[0]
+            ax.clear()
+        else:
+            from matplotlib.figure import Figure
+            from matplotlib.backends.backend_agg import FigureCanvasAgg
+            fig = Figure(figsize=figsize, constrained_layout=True)
+            FigureCanvasAgg(fig)
+            ax = fig.add_subplot(1, 1, 1)
+            _figure_pool[key] = fig
+        return fig, ax
+
+    @staticmethod
+    def _set_axes_properties(ax, ax_props):
+        # Explicit setters skip the generic property dispatch of ax.set.
+        # Limits go last so that changing scale does not autoscale them
+        if 'xlabel' in ax_props:
+            ax.set_xlabel(ax_props['xlabel'])
+        if 'ylabel' in ax_props:
+            ax.set_ylabel(ax_props['ylabel'])
+        if 'xscale' in ax_props:
+            ax.set_xscale(ax_props['xscale'])
+        if 'yscale' in ax_props:
+            ax.set_yscale(ax_props['yscale'])
+        if 'xlim' in ax_props:
+            ax.set_xlim(ax_props['xlim'])
+        if 'ylim' in ax_props:
+            ax.set_ylim(ax_props['ylim'])
+
+    @staticmethod
+    def _scatter_rasterized(ax, x, y, c=None, cmap=None, bins=512):
+        '''Show a point cloud as an image of its 2D histogram
+
+        Args:
+            ax (matplotlib.axes.Axes): The axes to plot into.
+            x (numpy.ndarray): Abscissae of the points.
+            y (numpy.ndarray): Ordinates of the points.
+            c (numpy.ndarray or None): If None, plot the log density of the \
+                    points using cmap. Otherwise, an N x 4 array of RGBA \
+                    colors of the points: each pixel gets the average color \
+                    of its points, and an opacity scaling with the log density.
+            cmap (matplotlib colormap): Colormap for the density.
+            bins (int): Number of pixels along each axis.
+
+        Returns:
+            the matplotlib.image.AxesImage.
+        '''
+        # Points with missing coordinates are not drawn by scatter either
+        finite = np.isfinite(x) & np.isfinite(y)
+        if not finite.all():
+            x = x[finite]
+            y = y[finite]
+            if c is not None:
+                c = c[finite]
+
+        h, xe, ye = np.histogram2d(x, y, bins=bins)
+        density = np.log1p(h)
+        if c is None:
+            img = np.ma.masked_equal(density, 0).T
+        else:
+            img = np.zeros((bins, bins, 4), float)
+            nonzero = h > 0
+            for i in range(3):
+                hw = np.histogram2d(x, y, bins=[xe, ye], weights=c[:, i])[0]
+                img[nonzero, i] = hw[nonzero] / h[nonzero]
+            img[:, :, 3] = density / density.max()
+            img = img.transpose(1, 0, 2)
+            cmap = None
+
+        return ax.imshow(
+                img,
+                origin='lower',
+                extent=[xe[0], xe[-1], ye[0], ye[-1]],
+                aspect='auto',
+                interpolation='nearest',
+                cmap=cmap,
+                )
+
+    @staticmethod
+    def _build_annotation(mapping, get_color_data):
+        '''Colors and colorbar info for clustermap annotations
+
+        Args:
+            mapping (dict): Keys are passed to get_color_data, values are
+                    palette names or palettes for qualitative data and
+                    colormap names or colormaps for quantitative data.
+            get_color_data (callable): Function taking a key of mapping
+                    and returning a pandas.Series with the data to color
+                    each sample or feature by.
+
+        Returns:
+            (colors, cbars) with a DataFrame of colors, one column per
+            key, and a list of dicts describing the colorbars.
+        '''
+        cbars = []
+        colors = []
+        for key, val in mapping.items():
+            color_data = get_color_data(key)
+            if not _is_numeric(color_data.dtype):
+                cmap_type = 'qualitative'
+                arr = color_data.values
+            else:
+                cmap_type = 'sequential'
+                # Rows of the counts are strided, make them contiguous
+                arr = np.ascontiguousarray(color_data.values)
+
+            if isinstance(val, str):
+                if cmap_type == 'qualitative':
+                    codes, cd_unique = pd.factorize(arr, sort=True)
+                    n_colors = len(cd_unique)
+                    palette = mpl.colors.to_rgba_array(
+                            sns.color_palette(val, n_colors=n_colors))
+                    # Missing values (code -1) take the extra grey last row
+                    c = np.vstack([palette, _to_rgba('lightgrey')])[codes]
+                    cbi = {'name': key, 'palette': palette,
+                           'ticklabels': cd_unique,
+                           'type': 'qualitative',
+                           'n_colors': n_colors}
+                else:
+                    cmap = _get_cmap(val)
+                    c, vmin, vmax = _sequential_colors(arr, cmap)
+                    cbi = {'name': key, 'cmap': cmap,
+                           'vmin': vmin, 'vmax': vmax,
+                           'type': 'sequential'}
+            else:
+                if cmap_type == 'qualitative':
+                    codes, cd_unique = pd.factorize(arr, sort=True)
+                    n_colors = len(cd_unique)
+                    if len(val) < n_colors:
+                        raise ValueError(
+                        'Palettes must have as many colors as there are categories')
+                    palette = mpl.colors.to_rgba_array(val)[:n_colors]
+                    # Missing values (code -1) take the extra grey last row
+                    c = np.vstack([palette, _to_rgba('lightgrey')])[codes]
+                    cbi = {'name': key, 'palette': palette,
+                           'ticklabels': cd_unique,
+                           'type': 'qualitative',
+                           'n_colors': n_colors}
+                else:
+                    cmap = val
+                    c, vmin, vmax = _sequential_colors(arr, cmap)
+                    cbi = {'name': key, 'cmap': cmap,
+                           'vmin': vmin, 'vmax': vmax,
+                           'type': 'sequential'}
+
+            colors.append(c)
+            cbars.append(cbi)
+
+        # Annotations x samples/features x RGBA, as nested lists of colors
+        colors = pd.DataFrame(
+                data=np.stack(colors).tolist(),
+                columns=color_data.index,
+                index=mapping.keys()).T
+
+        return colors, cbars
 
     def plot_coverage(
             self,
             features='total',
             kind='cumulative',
             ax=None,
-            tight_layout=True,
+            tight_layout=False,
             legend=False,
+            backend=None,
             **kwargs):
         '''Plot number of reads for each sample
 
@@ -83,9 +369,15 @@ class Plot(Plugin):
             tight_layout (bool or dict): Whether to call \
                     matplotlib.pyplot.tight_layout at the end of the \
                     plotting. If it is a dict, pass it unpacked to that \
-                    function.
+                    function. New figures use constrained layout, so this \
+                    is off by default.
             legend (bool or dict): If True, call ax.legend(). If a dict, \
                     pass as **kwargs to ax.legend.
+            backend (str or None): If 'agg' and ax is None, draw into a \
+                    pyplot-free Agg figure that is reused across calls \
+                    to this method (see Plot._new_axes), so each plot \
+                    must be saved before the next call. Use this for \
+                    batch export.
             **kwargs: named arguments passed to the plot function.
 
         Returns:
@@ -94,7 +386,8 @@ class Plot(Plugin):
 
         if ax is None:
             new_axes = True
-            fig, ax = plt.subplots(nrows=1, ncols=1, figsize=(13, 8))
+            fig, ax = Plot._new_axes(
+                    (13, 8), backend=backend, name='plot_coverage')
         else:
             new_axes = False
 
@@ -118,8 +411,8 @@ class Plot(Plugin):
 
         if kind == 'cumulative':
             x = counts.values.sum(axis=0)
-            x.sort()
-            y = 1.0 - np.linspace(0, 1, len(x))
+            x = np.sort(x)
+            y = np.linspace(1, 0, len(x))
             ax.plot(x, y, **kwargs)
             ax_props = {
                     'ylim': (-0.05, 1.05),
@@ -139,7 +432,7 @@ class Plot(Plugin):
             ax_props['xscale'] = 'log'
             ax.grid(True)
 
-        ax.set(**ax_props)
+        Plot._set_axes_properties(ax, ax_props)
 
         if legend:
             if np.isscalar(legend):
@@ -149,9 +442,9 @@ class Plot(Plugin):
 
         if tight_layout:
             if isinstance(tight_layout, dict):
-                plt.tight_layout(**tight_layout)
+                ax.figure.tight_layout(**tight_layout)
             else:
-                plt.tight_layout()
+                ax.figure.tight_layout()
 
         return ax
 
@@ -161,9 +454,10 @@ class Plot(Plugin):
             x='mean',
             y='cv',
             ax=None,
-            tight_layout=True,
+            tight_layout=False,
             legend=False,
             grid=None,
+            backend=None,
             **kwargs):
         '''Scatter plot statistics of features.
 
@@ -180,11 +474,17 @@ class Plot(Plugin):
             tight_layout (bool or dict): Whether to call \
                     matplotlib.pyplot.tight_layout at the end of the \
                     plotting. If it is a dict, pass it unpacked to that \
-                    function.
+                    function. New figures use constrained layout, so this \
+                    is off by default.
             legend (bool or dict): If True, call ax.legend(). If a dict, \
                     pass as **kwargs to ax.legend.
             grid (bool or None): Whether to add a grid to the plot. None \
                     defaults to your existing settings.
+            backend (str or None): If 'agg' and ax is None, draw into a \
+                    pyplot-free Agg figure that is reused across calls \
+                    to this method (see Plot._new_axes), so each plot \
+                    must be saved before the next call. Use this for \
+                    batch export.
             **kwargs: named arguments passed to the plot function.
 
         Returns:
@@ -192,7 +492,8 @@ class Plot(Plugin):
         '''
         if ax is None:
             new_axes = True
-            fig, ax = plt.subplots(nrows=1, ncols=1, figsize=(13, 8))
+            fig, ax = Plot._new_axes(
+                    (13, 8), backend=backend, name='scatter_statistics')
         else:
             new_axes = False
 
@@ -216,7 +517,25 @@ class Plot(Plugin):
         else:
             counts = counts.loc[features]
 
-        stats = counts.get_statistics(metrics=(x, y))
+        if {x, y} <= {'mean', 'std', 'cv'}:
+            mean_std = _get_mean_std_numba()
+        else:
+            mean_std = None
+
+        if mean_std is not None:
+            # Fused single pass over the counts
+            mean, std = mean_std(counts.values.astype(float, copy=False))
+            st = {
+                'mean': mean,
+                'std': std,
+                'cv': std / np.maximum(mean, 1e-10),
+                }
+            stats = pd.DataFrame(
+                    {x: st[x], y: st[y]},
+                    index=counts.index,
+                    columns=[x, y])
+        else:
+            stats = counts.get_statistics(metrics=(x, y))
         ax_props = {'xlabel': x, 'ylabel': y}
         x = stats.loc[:, x]
         y = stats.loc[:, y]
@@ -246,7 +565,7 @@ class Plot(Plugin):
         if grid is not None:
             ax.grid(grid)
 
-        ax.set(**ax_props)
+        Plot._set_axes_properties(ax, ax_props)
 
         if legend:
             if np.isscalar(legend):
@@ -256,21 +575,24 @@ class Plot(Plugin):
 
         if tight_layout:
             if isinstance(tight_layout, dict):
-                plt.tight_layout(**tight_layout)
+                ax.figure.tight_layout(**tight_layout)
             else:
-                plt.tight_layout()
+                ax.figure.tight_layout()
+
+        return ax
 
     def plot_distributions(
             self,
             features,
             kind='violin',
             ax=None,
-            tight_layout=True,
+            tight_layout=False,
             legend=False,
             orientation='vertical',
             sort=False,
             bottom=0,
             grid=None,
+            max_samples=1000,
             **kwargs):
         '''Plot distribution of spike-in controls
 
@@ -285,7 +607,8 @@ class Plot(Plugin):
             tight_layout (bool or dict): Whether to call \
                     matplotlib.pyplot.tight_layout at the end of the \
                     plotting. If it is a dict, pass it unpacked to that \
-                    function.
+                    function. New figures use constrained layout, so this \
+                    is off by default.
             legend (bool or dict): If True, call ax.legend(). If a dict, \
                     pass as **kwargs to ax.legend. Notice that legend has a \
                     special meaning in these kinds of seaborn plots.
@@ -299,13 +622,20 @@ class Plot(Plugin):
                     will be used.
             grid (bool or None): Whether to add a grid to the plot. None \
                     defaults to your existing settings.
+            max_samples (int or None): For violin and swarm plots, the \
+                    maximal number of samples to plot. If there are more, \
+                    a random (but reproducible) subsample is used, since the \
+                    cost of these plots grows faster than linearly with the \
+                    number of samples. None plots all samples.
             **kwargs: named arguments passed to the plot function.
 
         Return:
             matplotlib.axes.Axes: The axes with the plot.
         '''
         if ax is None:
-            fig, ax = plt.subplots(nrows=1, ncols=1, figsize=(18, 8))
+            fig, ax = plt.subplots(
+                    nrows=1, ncols=1, figsize=(18, 8),
+                    constrained_layout=True)
 
         counts = self.dataset.counts
 
@@ -317,13 +647,31 @@ class Plot(Plugin):
             counts = counts.loc[features]
 
         if sort:
-            asc = sort != 'descending'
-            ind = counts.median(axis=1).sort_values(ascending=asc).index
-            counts = counts.loc[ind]
+            order = np.argsort(np.median(counts.values, axis=1), kind='mergesort')
+            if sort == 'descending':
+                order = order[::-1]
+            counts = counts.iloc[order]
 
         if bottom == 'pseudocount':
             bottom = counts.pseudocount
-        counts = np.maximum(counts, bottom)
+        # Clip into a single preallocated buffer, the user data is untouched
+        cvals = counts.values
+        out = np.empty(cvals.shape, dtype=np.result_type(cvals, bottom))
+        np.clip(cvals, bottom, None, out=out)
+        counts = counts._constructor(
+                out,
+                index=counts.index,
+                columns=counts.columns,
+                ).__finalize__(counts)
+        vmax = out.max()
+
+        if ((kind in ('violin', 'swarm')) and (max_samples is not None) and
+           (counts.shape[1] > max_samples)):
+            rs = np.random.RandomState(0)
+            ind = np.sort(rs.choice(counts.shape[1], max_samples, replace=False))
+            counts_plot = counts.iloc[:, ind]
+        else:
+            counts_plot = counts
 
         ax_props = {}
         if kind == 'violin':
@@ -333,7 +681,7 @@ class Plot(Plugin):
                     }
             Plot._update_properties(kwargs, defaults)
             sns.violinplot(
-                    data=counts.T,
+                    data=counts_plot.T,
                     orient=orientation,
                     ax=ax,
                     **kwargs)
@@ -341,7 +689,7 @@ class Plot(Plugin):
             defaults = {}
             Plot._update_properties(kwargs, defaults)
             sns.boxplot(
-                    data=counts.T,
+                    data=counts_plot.T,
                     orient=orientation,
                     ax=ax,
                     **kwargs)
@@ -349,7 +697,7 @@ class Plot(Plugin):
             defaults = {}
             Plot._update_properties(kwargs, defaults)
             sns.swarmplot(
-                    data=counts.T,
+                    data=counts_plot.T,
                     orient=orientation,
                     ax=ax,
                     **kwargs)
@@ -357,24 +705,23 @@ class Plot(Plugin):
             raise ValueError('Plot kind not understood')
 
         if orientation == 'vertical':
-            ax_props['ylim'] = (0.9 * bottom, 1.1 * counts.values.max())
+            ax_props['ylim'] = (0.9 * bottom, 1.1 * vmax)
             if not counts._normalized:
                 ax_props['ylabel'] = 'Number of reads'
             elif counts._normalized != 'custom':
                 ax_props['ylabel'] = counts._normalized.capitalize().replace('_', ' ')
-            for label in ax.get_xmajorticklabels():
-                label.set_rotation(90)
-                label.set_horizontalalignment("center")
+            ax.tick_params(axis='x', labelrotation=90)
+            plt.setp(ax.get_xmajorticklabels(), ha='center')
             ax.grid(True, 'y')
         elif orientation == 'horizontal':
-            ax_props['xlim'] = (0.9 * bottom, 1.1 * counts.values.max())
+            ax_props['xlim'] = (0.9 * bottom, 1.1 * vmax)
             if not counts._normalized:
                 ax_props['xlabel'] = 'Number of reads'
             elif counts._normalized != 'custom':
                 ax_props['xlabel'] = counts._normalized.capitalize().replace('_', ' ')
             ax.grid(True, axis='x')
 
-        ax.set(**ax_props)
+        Plot._set_axes_properties(ax, ax_props)
 
         if grid is not None:
             ax.grid(grid)
@@ -401,8 +748,9 @@ class Plot(Plugin):
             cmap='viridis',
             default_color='darkgrey',
             ax=None,
-            tight_layout=True,
+            tight_layout=False,
             high_on_top=False,
+            rasterize='auto',
             **kwargs):
         '''Scatter samples or features after dimensionality reduction.
 
@@ -430,9 +778,18 @@ class Plot(Plugin):
             tight_layout (bool or dict): Whether to call
                 matplotlib.pyplot.tight_layout at the end of the
                 plotting. If it is a dict, pass it unpacked to that
-                function.
+                function. New figures use constrained layout, so this is
+                off by default.
             high_on_top (bool): Plot high expression/phenotype values on top.
                 This argument is ignored for categorical phenotypes.
+            rasterize (bool or str): Whether to aggregate the points into a
+                2D histogram and show it as an image instead of a scatter
+                plot. Without color_by, the image is the (log) density of
+                points in cmap, otherwise each pixel takes the average color
+                of its points. 'auto' (default) rasterizes above 50,000
+                points, for which scatter plots become unresponsive. The
+                image ignores marker properties in kwargs (size, alpha,
+                marker, etc.), with a warning if any are passed.
             **kwargs: named arguments passed to the plot function.
 
         Returns:
@@ -442,11 +799,11 @@ class Plot(Plugin):
         color is stored into ax._singlet_cmap.
         '''
         if isinstance(vectors_reduced, tuple):
-            if pd.Index(vectors_reduced).isin(self.dataset.samplesheet.columns).all():
+            if all(v in self.dataset.samplesheet.columns for v in vectors_reduced):
                 vectors_reduced = self.dataset.samplesheet[list(vectors_reduced)]
                 data = self.dataset.counts
                 metadata = self.dataset.samplesheet
-            elif pd.Index(vectors_reduced).isin(self.dataset.featuresheet.columns).all():
+            elif all(v in self.dataset.featuresheet.columns for v in vectors_reduced):
                 vectors_reduced = self.dataset.featuresheet[list(vectors_reduced)]
                 data = self.dataset.counts.T
                 metadata = self.dataset.featuresheet
@@ -463,25 +820,25 @@ class Plot(Plugin):
                 raise ValueError('reduced_vectors is not consistent with samples nor features')
 
         if ax is None:
-            fig, ax = plt.subplots(nrows=1, ncols=1, figsize=(13, 8))
+            fig, ax = plt.subplots(
+                    nrows=1, ncols=1, figsize=(13, 8),
+                    constrained_layout=True)
 
+        user_kwargs = set(kwargs)
         defaults = {
                 's': 90,
                 }
         Plot._update_properties(kwargs, defaults)
-        tiers = np.ones(vectors_reduced.shape[0])
+        order = None
 
         if color_by is None:
             kwargs['color'] = default_color
         else:
             if isinstance(cmap, str):
-                cmap = cm.get_cmap(cmap)
+                cmap = _get_cmap(cmap)
             if color_by in metadata.columns:
                 color_data = metadata.loc[:, color_by]
-                if hasattr(color_data, 'cat'):
-                    color_is_numeric = False
-                else:
-                    color_is_numeric = np.issubdtype(color_data.dtype, np.number)
+                color_is_numeric = _is_numeric(color_data.dtype)
                 color_by_phenotype = True
             elif color_by in data.index:
                 color_data = data.loc[color_by]
@@ -492,17 +849,26 @@ class Plot(Plugin):
                     'The label '+color_by+' is neither a phenotype nor a feature')
 
             # Categorical columns get just a list or a dict of colors
-            if (hasattr(color_data, 'cat')) or (not color_is_numeric):
-                cd_unique = list(np.unique(color_data.values))
+            if not color_is_numeric:
+                # Only observed values take colors, not unused categories
+                codes, cd_unique = pd.factorize(color_data.values, sort=True)
+                cd_unique = list(cd_unique)
                 if callable(cmap):
                     c_unique = cmap(np.linspace(0, 1, len(cd_unique)))
                 elif isinstance(cmap, dict):
-                    c_unique = np.asarray([cmap.get(x, default_color) for x in cd_unique])
+                    c_unique = [cmap.get(x, default_color) for x in cd_unique]
                 else:
-                    c_unique = np.asarray(cmap)
-
-                # Assign the actual colors to categories. Missing ones default
-                c = c_unique[[cd_unique.index(x) for x in color_data.values]]
+                    if len(cmap) < len(cd_unique):
+                        raise ValueError(
+                        'Palettes must have as many colors as there are categories')
+                    c_unique = cmap[:len(cd_unique)]
+                c_unique = mpl.colors.to_rgba_array(c_unique)
+
+                # Assign the actual colors to categories. Missing ones (code
+                # -1) default, hence the extra last row
+                c_lookup = np.vstack(
+                    [c_unique, _to_rgba(default_color)])
+                c = c_lookup[codes]
 
                 # For categories, we have to tell the user about the mapping
                 if not hasattr(ax, '_singlet_cmap'):
@@ -511,13 +877,15 @@ class Plot(Plugin):
 
             # Non-categorical numeric types are more tricky: check for NaNs
             else:
-                if np.isnan(color_data.values).any():
-                    unmask = ~np.isnan(color_data.values)
+                cd = color_data.values
+                unmask = ~np.isnan(cd)
+                if unmask.all():
+                    cd_min = cd.min()
+                    cd_max = cd.max()
                 else:
-                    unmask = np.ones(len(color_data), bool)
-
-                cd_min = color_data.values[unmask].min()
-                cd_max = color_data.values[unmask].max()
+                    cd_valid = cd[unmask]
+                    cd_min = cd_valid.min()
+                    cd_max = cd_valid.max()
 
                 if color_log is None:
                     color_log = not color_by_phenotype
@@ -527,44 +895,77 @@ class Plot(Plugin):
                         pc = 0.1 * cd_min
                     else:
                         pc = self.dataset.counts.pseudocount
-                    color_data = np.log10(color_data + pc)
+                    # Single precision is plenty for a colormap; one buffer
+                    cd = cd.astype(np.float32)
+                    cd += pc
+                    np.log10(cd, out=cd)
                     cd_min = np.log10(cd_min + pc)
                     cd_max = np.log10(cd_max + pc)
 
-                cd_norm = (color_data.values - cd_min) / (cd_max - cd_min)
-
-                if high_on_top:
-                    tiers = pd.qcut(
-                            cd_norm, np.linspace(0, 1, 5),
-                            retbins=False, labels=False,
-                            duplicates='drop',
-                            )
+                cd_norm = np.empty(len(cd), float)
+                np.subtract(cd, cd_min, out=cd_norm)
+                cd_norm /= cd_max - cd_min
 
+                if high_on_top and (len(cd_norm) > 1):
+                    # Drawing order by quartile via a single partition, not
+                    # a full sort. NaNs go to the bottom
+                    n = len(cd_norm)
+                    kth = np.unique([n // 4, n // 2, 3 * n // 4])
+                    order = np.argpartition(
+                            np.where(unmask, cd_norm, -np.inf), kth)
 
-                c = np.zeros((len(color_data), 4), float)
-                c[unmask] = cmap(cd_norm[unmask])
-                # Grey-ish semitransparency for NaNs
-                c[~unmask] = mpl.colors.to_rgba(default_color, alpha=0.3)
+                # One contiguous RGBA array: the colormap maps NaNs to its
+                # "bad" color, which is then replaced by a grey-ish
+                # semitransparency
+                c = cmap(cd_norm)
+                c[~unmask] = _to_rgba(default_color, alpha=0.3)
 
             kwargs['c'] = c
 
-        tiers_unique = np.sort(np.unique(tiers))
-        for t in tiers_unique:
-            ind = tiers == t
-            vec = vectors_reduced.loc[ind]
-            kw = dict(kwargs)
-            if 'c' in kw:
-                if (not isinstance(kw['c'], str)) and (len(kw['c']) == len(vec)):
-                    kw['c'] = kw['c'][ind]
-            if not np.isscalar(kw['s']):
-                kw['s'] = kw['s'][ind]
-            vec.plot(
-                    x=vec.columns[0],
-                    y=vec.columns[1],
-                    kind='scatter',
-                    ax=ax,
-                    **kw)
-
+        xv = vectors_reduced.iloc[:, 0].values
+        yv = vectors_reduced.iloc[:, 1].values
+        kw = dict(kwargs)
+
+        if rasterize == 'auto':
+            rasterize = len(xv) > 50000
+
+        if rasterize:
+            if user_kwargs:
+                warnings.warn(
+                    'Rasterized scatter ignores the arguments: {:}'.format(
+                        ', '.join(sorted(user_kwargs))))
+            if color_by is None:
+                if isinstance(cmap, str):
+                    cmap = _get_cmap(cmap)
+                c = None
+            else:
+                c = kw['c']
+            Plot._scatter_rasterized(ax, xv, yv, c=c, cmap=cmap)
+
+        # A single color and size needs no per-point mapping: a marker-only
+        # line is much faster to draw than a scatter collection. Properties
+        # of scatter markers such as edgecolors or linewidths have no
+        # exact Line2D counterpart, so those still go through ax.scatter
+        elif ((color_by is None) and np.isscalar(kw['s']) and
+              Plot._MARKER_LINE_KEYS.issuperset(kw)):
+            kw['markersize'] = np.sqrt(kw.pop('s'))
+            kw.setdefault('marker', 'o')
+            kw['linestyle'] = 'none'
+            ax.plot(xv, yv, **kw)
+        else:
+            # Points are drawn in order within a single collection, so
+            # the last quartiles end up on top
+            if order is not None:
+                xv = xv[order]
+                yv = yv[order]
+                if ('c' in kw) and (not isinstance(kw['c'], str)):
+                    kw['c'] = kw['c'][order]
+                if not np.isscalar(kw['s']):
+                    kw['s'] = np.asarray(kw['s'])[order]
+            ax.scatter(xv, yv, **kw)
+
+        ax.set_xlabel(vectors_reduced.columns[0])
+        ax.set_ylabel(vectors_reduced.columns[1])
         ax.grid(True)
 
         if tight_layout:
@@ -582,7 +983,7 @@ class Plot(Plugin):
             color_log=None,
             cmap='viridis',
             ax=None,
-            tight_layout=True,
+            tight_layout=False,
             **kwargs):
         '''Scatter samples after dimensionality reduction.
 
@@ -606,7 +1007,8 @@ class Plot(Plugin):
             tight_layout (bool or dict): Whether to call
                 matplotlib.pyplot.tight_layout at the end of the
                 plotting. If it is a dict, pass it unpacked to that
-                function.
+                function. New figures use constrained layout, so this is
+                off by default.
             **kwargs: named arguments passed to the plot function.
 
         Returns:
@@ -721,137 +1123,30 @@ class Plot(Plugin):
         else:
             linkage_features = cluster_features
 
+        counts = self.dataset.counts
         if annotate_samples:
-            cbars_samples = []
-            col_samples = []
-            for key, val in annotate_samples.items():
-                if key in self.dataset.samplesheet.columns:
-                    color_data = self.dataset.samplesheet.loc[:, key]
-                    is_numeric = np.issubdtype(color_data.dtype, np.number)
-                    if (color_data.dtype.name == 'category') or (not is_numeric):
-                        cmap_type = 'qualitative'
-                    else:
-                        cmap_type = 'sequential'
-                else:
-                    color_data = self.dataset.counts.loc[key]
-                    cmap_type = 'sequential'
-
-                if isinstance(val, str):
-                    if cmap_type == 'qualitative':
-                        cd_unique = list(np.unique(color_data.values))
-                        n_colors = len(cd_unique)
-                        palette = sns.color_palette(val, n_colors=n_colors)
-                        c = [palette[cd_unique.index(x)] for x in color_data.values]
-                        cbi = {'name': key, 'palette': palette,
-                               'ticklabels': cd_unique,
-                               'type': 'qualitative',
-                               'n_colors': n_colors}
-                    else:
-                        cmap = cm.get_cmap(val)
-                        vmax = np.nanmax(color_data.values)
-                        vmin = np.nanmin(color_data.values)
-                        cval = (color_data.values - vmin) / (vmax - vmin)
-                        c = cmap(cval)
-                        cbi = {'name': key, 'cmap': cmap,
-                               'vmin': vmin, 'vmax': vmax,
-                               'type': 'sequential'}
-                else:
-                    if cmap_type == 'qualitative':
-                        cd_unique = list(np.unique(color_data.values))
-                        n_colors = len(cd_unique)
-                        if len(palette) < n_colors:
-                            raise ValueError(
-                            'Palettes must have as many colors as there are categories')
-                        palette = val
-                        c = [palette[cd_unique.index(x)] for x in color_data.values]
-                        cbi = {'name': key, 'palette': palette[:n_colors],
-                               'ticks': cd_unique,
-                               'type': 'qualitative',
-                               'n_colors': n_colors}
-                    else:
-                        cmap = val
-                        vmax = np.nanmax(color_data.values)
-                        vmin = np.nanmin(color_data.values)
-                        cval = (color_data.values - vmin) / (vmax - vmin)
-                        c = cmap(cval)
-                        cbi = {'name': key, 'cmap': cmap,
-                               'vmin': vmin, 'vmax': vmax,
-                               'type': 'sequential'}
-
-                col_samples.append(c)
-                cbars_samples.append(cbi)
-
-            col_samples = pd.DataFrame(
-                    data=[list(a) for a in col_samples],
-                    columns=color_data.index,
-                    index=annotate_samples.keys()).T
+            samplesheet = self.dataset.samplesheet
+
+            def get_color_data(key):
+                if key in samplesheet.columns:
+                    return samplesheet.loc[:, key]
+                return counts.loc[key]
+
+            col_samples, cbars_samples = Plot._build_annotation(
+                    annotate_samples, get_color_data)
         else:
             col_samples = None
 
         if annotate_features:
-            cbars_features = []
-            col_features = []
-            for key, val in annotate_features.items():
+            featuresheet = self.dataset.featuresheet
+
+            def get_color_data(key):
                 if key == 'mean expression':
-                    color_data = self.dataset.counts.mean(axis=1)
-                else:
-                    color_data = self.dataset.featuresheet.loc[:, key]
-                is_numeric = np.issubdtype(color_data.dtype, np.number)
-                if (color_data.dtype.name == 'category') or (not is_numeric):
-                    cmap_type = 'qualitative'
-                else:
-                    cmap_type = 'sequential'
-
-                if isinstance(val, str):
-                    if cmap_type == 'qualitative':
-                        cd_unique = list(np.unique(color_data.values))
-                        n_colors = len(cd_unique)
-                        palette = sns.color_palette(val, n_colors=n_colors)
-                        c = [palette[cd_unique.index(x)] for x in color_data.values]
-                        cbi = {'name': key, 'palette': palette,
-                               'ticklabels': cd_unique,
-                               'type': 'qualitative',
-                               'n_colors': n_colors}
-                    else:
-                        cmap = cm.get_cmap(val)
-                        vmax = np.nanmax(color_data.values)
-                        vmin = np.nanmin(color_data.values)
-                        cval = (color_data.values - vmin) / (vmax - vmin)
-                        c = cmap(cval)
-                        cbi = {'name': key, 'cmap': cmap,
-                               'vmin': vmin, 'vmax': vmax,
-                               'type': 'sequential'}
-                else:
-                    if cmap_type == 'qualitative':
-                        cd_unique = list(np.unique(color_data.values))
-                        n_colors = len(cd_unique)
-                        if len(palette) < n_colors:
-                            raise ValueError(
-                            'Palettes must have as many colors as there are categories')
-                        palette = val
-                        c = [palette[cd_unique.index(x)] for x in color_data.values]
-                        cbi = {'name': key, 'palette': palette[:n_colors],
-                               'ticks': cd_unique,
-                               'type': 'qualitative',
-                               'n_colors': n_colors}
-                    else:
-                        cmap = val
-                        vmax = np.nanmax(color_data.values)
-                        vmin = np.nanmin(color_data.values)
-                        cval = (color_data.values - vmin) / (vmax - vmin)
-                        c = cmap(cval)
-                        cbi = {'name': key, 'cmap': cmap,
-                               'vmin': vmin, 'vmax': vmax,
-                               'type': 'sequential'}
-
-                col_features.append(c)
-                cbars_features.append(cbi)
-
-            col_features = pd.DataFrame(
-                    data=[list(a) for a in col_features],
-                    columns=color_data.index,
-                    index=annotate_features.keys()).T
+                    return counts.mean(axis=1)
+                return featuresheet.loc[:, key]
 
+            col_features, cbars_features = Plot._build_annotation(
+                    annotate_features, get_color_data)
         else:
             col_features = None
 
@@ -908,12 +1203,10 @@ class Plot(Plugin):
                 **kwargs)
 
         ax = g.ax_heatmap
-        for label in ax.get_xmajorticklabels():
-            label.set_rotation(90)
-            label.set_horizontalalignment("center")
-        for label in ax.get_ymajorticklabels():
-            label.set_rotation(0)
-            label.set_verticalalignment("center")
+        ax.tick_params(axis='x', labelrotation=90)
+        ax.tick_params(axis='y', labelrotation=0)
+        plt.setp(ax.get_xmajorticklabels(), ha='center')
+        plt.setp(ax.get_ymajorticklabels(), va='center')
 
         if not row_labels:
             ax.set_ylabel(ylabel)
@@ -949,8 +1242,8 @@ class Plot(Plugin):
                                 **kw)
                     else:
                         n_colors = cbi['n_colors']
-                        bounds = [1.0 * i / n_colors for i in range(n_colors + 1)]
-                        ticks = [(2.0 * i + 1) / (n_colors * 2) for i in range(n_colors)]
+                        bounds = np.linspace(0.0, 1.0, n_colors + 1)
+                        ticks = (np.arange(n_colors) + 0.5) / n_colors
                         kw['norm'] = mpl.colors.Normalize(vmin=0, vmax=1)
                         cmap = mpl.colors.ListedColormap(cbi['palette'])
                         cb = mpl.colorbar.ColorbarBase(
@@ -1008,8 +1301,8 @@ class Plot(Plugin):
                                 **kw)
                     else:
                         n_colors = cbi['n_colors']
-                        bounds = [1.0 * i / n_colors for i in range(n_colors + 1)]
-                        ticks = [(2.0 * i + 1) / (n_colors * 2) for i in range(n_colors)]
+                        bounds = np.linspace(0.0, 1.0, n_colors + 1)
+                        ticks = (np.arange(n_colors) + 0.5) / n_colors
                         kw['norm'] = mpl.colors.Normalize(vmin=0, vmax=1)
                         cmap = mpl.colors.ListedColormap(cbi['palette'])
                         cb = mpl.colorbar.ColorbarBase(
@@ -1058,7 +1351,7 @@ class Plot(Plugin):
             layout='horizontal',
             cmap='plasma',
             ax=None,
-            tight_layout=True,
+            tight_layout=False,
             **kwargs):
         '''Group samples and plot fraction and levels of counts.
 
@@ -1100,7 +1393,8 @@ class Plot(Plugin):
             tight_layout (bool or dict): Whether to call
                 matplotlib.pyplot.tight_layout at the end of the
                 plotting. If it is a dict, pass it unpacked to that
-                function.
+                function. New figures use constrained layout, so this is
+                off by default.
             **kwargs: named arguments passed to the plot function.
 
         Returns:
@@ -1112,7 +1406,9 @@ class Plot(Plugin):
 
         if ax is None:
             new_axes = True
-            fig, ax = plt.subplots(nrows=1, ncols=1, figsize=(10, 8))
+            fig, ax = plt.subplots(
+                    nrows=1, ncols=1, figsize=(10, 8),
+                    constrained_layout=True)
         else:
             new_axes = False
 
@@ -1142,71 +1438,73 @@ class Plot(Plugin):
             data[group_by] = self.dataset.featuresheet[group_by]
 
         if group_order is None:
-            groups = list(set(data[group_by]))
+            groups = pd.unique(data[group_by]).tolist()
         else:
             groups = list(group_order)
-        points = []
-        for ig, count in enumerate(plot_list):
-            gexist = data[group_by].unique()
-            gby = data[[count, group_by]].groupby(group_by)
-            clog = color_log or ((color_log is None) and (count in plot_listc))
-            for ct in groups:
-                if ct not in gexist:
-                    continue
-                dfi = gby.get_group(ct)
-                frac_exp = (dfi[count] >= threshold).mean()
-                if clog:
-                    mean_exp = np.log10(dfi[count].values + self.dataset.counts.pseudocount).mean()
-                else:
-                    mean_exp = dfi[count].values.mean()
-                point = {
-                    'fraction': frac_exp,
-                    'level': mean_exp,
-                    'group': ct,
-                    'count': count,
-                    }
-                if layout == 'horizontal':
-                    point['x'] = ig
-                    point['y'] = groups.index(ct)
-                elif layout == 'vertical':
-                    point['x'] = groups.index(ct)
-                    point['y'] = ig
-                else:
-                    raise ValueError(
-                            'Layout must be "horizontal" or "vertical"')
-                points.append(point)
-
-        points = pd.DataFrame(points)
-        points.set_index(['count', 'group'], inplace=True, drop=False)
+        group_pos = {ct: i for i, ct in enumerate(groups)}
+        gexist = set(data[group_by].unique())
+        groups_exist = [ct for ct in groups if ct in gexist]
+
+        if color_log:
+            plot_listl = plot_list
+        elif color_log is None:
+            plot_listl = plot_listc
+        else:
+            plot_listl = []
+
+        # Aggregate all of plot_list at once, as groups x plot_list
+        gkeys = data[group_by]
+        values = data.loc[:, plot_list].astype(float)
+        fractions = (values >= threshold).astype(float).groupby(gkeys).mean()
+        if plot_listl:
+            # Log each element once, in place on a private copy of the
+            # block (.values may be read-only under copy-on-write)
+            logged = values[plot_listl].to_numpy(dtype=float, copy=True)
+            logged += self.dataset.counts.pseudocount
+            np.log10(logged, out=logged)
+            values[plot_listl] = logged
+        levels = values.groupby(gkeys).mean()
+
+        points = pd.DataFrame({
+            'fraction': fractions.loc[groups_exist].unstack(),
+            'level': levels.loc[groups_exist].unstack(),
+            })
+        points.index.names = ['count', 'group']
+        points.reset_index(inplace=True)
+
+        icount = np.repeat(np.arange(len(plot_list)), len(groups_exist))
+        igroup = points['group'].map(group_pos).values
+        if layout == 'horizontal':
+            points['x'] = icount
+            points['y'] = igroup
+        elif layout == 'vertical':
+            points['x'] = igroup
+            points['y'] = icount
+        else:
+            raise ValueError(
+                    'Layout must be "horizontal" or "vertical"')
 
         # Set size and color based on fraction and level
-        points['s'] = 0.0
-        points['c'] = 0.0
-        for count in plot_list:
-            if vmin == 'min':
-                vm = points['level'].values.min()
-            elif vmin == 'min_single':
-                vm = points.loc[points['count'] == count, 'level'].values.min()
-            else:
-                vm = vmin
+        points['s'] = size_fun(points['fraction'].values)
 
-            if vmax == 'max':
-                vM = points['level'].values.max()
-            elif vmax == 'max_single':
-                vM = points.loc[points['count'] == count, 'level'].values.max()
-            else:
-                vM = vmax
+        if vmin == 'min':
+            vm = points['level'].values.min()
+        elif vmin == 'min_single':
+            vm = points.groupby('count')['level'].transform('min').values
+        else:
+            vm = vmin
 
-            for gr in groups:
-                if gr not in gexist:
-                    continue
-                size = size_fun(points.at[(count, gr), 'fraction'])
-                shade = (points.at[(count, gr), 'level'] - vm) / (vM - vm)
-                points.at[(count, gr), 's'] = size
-                points.at[(count, gr), 'c'] = shade
+        if vmax == 'max':
+            vM = points['level'].values.max()
+        elif vmax == 'max_single':
+            vM = points.groupby('count')['level'].transform('max').values
+        else:
+            vM = vmax
+
+        points['c'] = (points['level'].values - vm) / (vM - vm)
 
         if isinstance(cmap, str):
-            cmap = cm.get_cmap(cmap)
+            cmap = _get_cmap(cmap)
 
         ax.scatter(
             points['x'].values,
@@ -1258,7 +1556,7 @@ class Plot(Plugin):
             ax=None,
             log=False,
             ymin=0,
-            tight_layout=True,
+            tight_layout=False,
             legend=False,
             ):
         '''Plot changes in sample abundance groups (e.g. in time)
@@ -1293,13 +1591,12 @@ class Plot(Plugin):
             tight_layout (bool or dict): Whether to call
                 matplotlib.pyplot.tight_layout at the end of the
                 plotting. If it is a dict, pass it unpacked to that function.
+                New figures use constrained layout, so this is off by default.
             legend (bool or dict): If True, call ax.legend(). If a dict, pass
                 as **kwargs to ax.legend.
         Returns:
             matplotlib.pyplot axes with the abundance changes
         '''
-        from scipy import interpolate
-
         data = self.dataset.samplesheet[[groupby, along]].copy()
         data['__count__'] = 1
         data = (data.groupby([groupby, along])
@@ -1320,7 +1617,9 @@ class Plot(Plugin):
             data = np.log(data) / np.log(log)
 
         if ax is None:
-            fig, ax = plt.subplots(nrows=1, ncols=1, figsize=(13, 8))
+            fig, ax = plt.subplots(
+                    nrows=1, ncols=1, figsize=(13, 8),
+                    constrained_layout=True)
 
         if group_order is not None:
             data = data.loc[group_order]
@@ -1331,9 +1630,15 @@ class Plot(Plugin):
         x = np.arange(data.shape[1])
         xorder = data.columns
         gorder = data.index
+        Y = data.values
+
+        if interpolate:
+            # One spline evaluation for all groups at once
+            outx = np.linspace(x[0], x[-1], 100)
+            outY = _pchip(x, Y, outx, axis=1)
 
         for ig, go in enumerate(gorder):
-            y = data.loc[go]
+            y = Y[ig]
 
             kwargs = {}
             if isinstance(cmap, dict):
@@ -1351,13 +1656,10 @@ class Plot(Plugin):
                     )
 
             if interpolate:
-                outx = np.linspace(x[0], x[-1], 100)
-                outy = interpolate.pchip_interpolate(x, y, outx)
-
                 in_kwargs = kwargs.copy()
                 in_kwargs.update(interpolate_kwargs)
 
-                ax.plot(outx, outy,
+                ax.plot(outx, outY[ig],
                         **in_kwargs,
                         )
 
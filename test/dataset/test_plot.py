@@ -86,6 +86,49 @@ def test_scatter_reduced(ds, vs):
     assert(compare_images(fdn_base+fn, fdn_tmp+fn, tol=tol) is None)
 
 
+@pytest.mark.skipif(miss_mpl, reason='No maplotlib available')
+def test_scatter_reduced_edgecolor(ds, vs):
+    fig, ax = plt.subplots()
+    ds.plot.scatter_reduced_samples(
+            vs,
+            ax=ax,
+            edgecolor='none',
+            linewidths=2,
+            )
+    plt.close(fig)
+    assert(len(ax.lines) == 0)
+    assert(len(ax.collections) == 1)
+    assert(len(ax.collections[0].get_edgecolors()) == 0)
+    assert(np.allclose(ax.collections[0].get_linewidths(), 2))
+
+
+@pytest.mark.skipif(miss_mpl, reason='No maplotlib available')
+def test_scatter_reduced_rasterize(ds, vs):
+    vsnan = vs.astype(float)
+    vsnan.iloc[0, 0] = np.nan
+    for color_by in (None, 'quantitative_phenotype_1_[A.U.]'):
+        fig, ax = plt.subplots()
+        ds.plot.scatter_reduced_samples(
+                vsnan,
+                ax=ax,
+                color_by=color_by,
+                rasterize=True,
+                )
+        plt.close(fig)
+        assert(len(ax.images) == 1)
+        assert(len(ax.collections) == 0)
+
+    fig, ax = plt.subplots()
+    with pytest.warns(UserWarning):
+        ds.plot.scatter_reduced_samples(
+                vs,
+                ax=ax,
+                rasterize=True,
+                s=10,
+                )
+    plt.close(fig)
+
+
 @pytest.mark.skipif(miss_mpl, reason='No maplotlib available')
 def test_scatter_reduced_colorby(ds, vs):
     fig, ax = plt.subplots()
@@ -100,6 +143,39 @@ def test_scatter_reduced_colorby(ds, vs):
     assert(compare_images(fdn_base+fn, fdn_tmp+fn, tol=tol) is None)
 
 
+@pytest.mark.skipif(miss_mpl, reason='No maplotlib available')
+def test_scatter_reduced_colorby_categorical(ds, vs):
+    fig, ax = plt.subplots()
+    ds.plot.scatter_reduced_samples(
+            vs,
+            ax=ax,
+            tight_layout=False,
+            color_by='experiment',
+            cmap='Set1')
+    plt.close(fig)
+    cmap = ax._singlet_cmap
+    assert(set(cmap.keys()) == set(ds.samplesheet['experiment']))
+    assert(all(len(c) == 4 for c in cmap.values()))
+
+
+@pytest.mark.skipif(miss_mpl, reason='No maplotlib available')
+def test_scatter_reduced_colorby_unused_categories(ds, vs):
+    ds2 = ds.copy()
+    ds2.samplesheet['cat'] = pd.Categorical(
+            ds2.samplesheet['experiment'],
+            categories=['aaa', 'exp1', 'test_pipeline', 'zzz'])
+    fig, ax = plt.subplots()
+    ds2.plot.scatter_reduced_samples(
+            vs,
+            ax=ax,
+            color_by='cat',
+            cmap=['red', 'blue'])
+    plt.close(fig)
+    cmap = ax._singlet_cmap
+    assert(set(cmap.keys()) == {'exp1', 'test_pipeline'})
+    assert(np.allclose(cmap['exp1'], matplotlib.colors.to_rgba('red')))
+
+
 @pytest.mark.skipif(miss_mpl, reason='No maplotlib available')
 def test_plot_coverage_total(ds, vs):
     fig, ax = plt.subplots()
@@ -188,6 +264,40 @@ def test_plot_scatter_statistics(ds, vs):
     assert(compare_images(fdn_base+fn, fdn_tmp+fn, tol=tol) is None)
 
 
+@pytest.mark.skipif(miss_mpl, reason='No maplotlib available')
+def test_agg_backend_figures(ds):
+    ax_cov = ds.plot.plot_coverage(features='total', backend='agg')
+    ax_stat = ds.plot.scatter_statistics(features='mapped', backend='agg')
+    assert(ax_cov is not ax_stat)
+    assert(len(ax_cov.lines) == 1)
+    ax_cov2 = ds.plot.plot_coverage(features='mapped', backend='agg')
+    assert(ax_cov2 is ax_cov)
+    assert(len(ax_cov2.lines) == 1)
+
+
+def test_mean_std_numba(ds):
+    from singlet.dataset import plot
+    mean_std = plot._get_mean_std_numba()
+    if mean_std is None:
+        pytest.skip('No numba available')
+    mean, std = mean_std(ds.counts.values.astype(float))
+    st = ds.counts.get_statistics(metrics=('mean', 'std'))
+    assert(np.allclose(mean, st['mean'].values))
+    assert(np.allclose(std, st['std'].values))
+
+
+@pytest.mark.skipif(miss_mpl, reason='No maplotlib available')
+def test_scatter_statistics_values(ds):
+    fig, ax = plt.subplots()
+    ds.plot.scatter_statistics(features='mapped', x='mean', y='cv', ax=ax)
+    plt.close(fig)
+    counts = ds.counts.exclude_features(
+            spikeins=True, other=True, errors='ignore')
+    st = counts.get_statistics(metrics=('mean', 'cv'))
+    offsets = ax.collections[0].get_offsets()
+    assert(np.allclose(offsets, st[['mean', 'cv']].values, equal_nan=True))
+
+
 @pytest.mark.skipif(miss_mpl, reason='No maplotlib available')
 def test_distribution_spikeins_violin(ds, vs):
     fig, ax = plt.subplots()
@@ -320,6 +430,43 @@ def test_clustermap_noclustering_annosamples(dssmall):
     assert(compare_images(fdn_base+fn, fdn_tmp+fn, tol=tol) is None)
 
 
+@pytest.mark.skipif(miss_mpl, reason='No maplotlib available')
+def test_clustermap_annosamples_custom_palette(dssmall):
+    g = dssmall.plot.clustermap(
+            cluster_samples=False,
+            cluster_features=False,
+            annotate_samples={'experiment': ['red', 'blue', 'green']},
+            colorbars=True)
+    labels = [t.get_text() for t in g.ax_cbars_columns[0].get_xticklabels()]
+    plt.close(g.fig)
+    assert(labels == ['exp1', 'test_pipeline'])
+
+    dsnan = dssmall.copy()
+    dsnan.samplesheet['experiment'] = dsnan.samplesheet['experiment'].where(
+            dsnan.samplesheet['experiment'] != 'exp1')
+    g = dsnan.plot.clustermap(
+            cluster_samples=False,
+            cluster_features=False,
+            annotate_samples={'experiment': ['red', 'blue', 'green']},
+            colorbars=True)
+    plt.close(g.fig)
+    from singlet.dataset.plot import Plot
+    colors, cbars = Plot._build_annotation(
+            {'experiment': ['red', 'blue', 'green']},
+            lambda key: dsnan.samplesheet[key])
+    assert(len(cbars[0]['palette']) == 1)
+    assert(np.allclose(cbars[0]['palette'][0], matplotlib.colors.to_rgba('red')))
+    isnan = dsnan.samplesheet['experiment'].isnull()
+    grey = matplotlib.colors.to_rgba('lightgrey')
+    for sn, color in colors['experiment'].items():
+        expected = grey if isnan[sn] else matplotlib.colors.to_rgba('red')
+        assert(np.allclose(color, expected))
+
+    with pytest.raises(ValueError):
+        dssmall.plot.clustermap(
+                annotate_samples={'experiment': ['red']})
+
+
 @pytest.mark.skipif(miss_mpl, reason='No maplotlib available')
 def test_clustermap_noclustering_vertical(dssmall):
     g = dssmall.plot.clustermap(
@@ -348,3 +495,123 @@ def test_clustermap_noclustering_annofeatures(dssmall):
     fig.savefig(fdn_tmp+fn)
     plt.close(fig)
     assert(compare_images(fdn_base+fn, fdn_tmp+fn, tol=tol) is None)
+
+
+@pytest.mark.skipif(miss_mpl, reason='No maplotlib available')
+def test_clustermap_annotation_missing_values():
+    from singlet.dataset.plot import Plot
+    data = pd.Series(['a', 'b', np.nan, 'a'], index=list('wxyz'))
+    colors, cbars = Plot._build_annotation(
+            {'cat': 'Set1'}, lambda key: data)
+    grey = matplotlib.colors.to_rgba('lightgrey')
+    palette = cbars[0]['palette']
+    assert(list(cbars[0]['ticklabels']) == ['a', 'b'])
+    assert(np.allclose(colors.loc['w', 'cat'], palette[0]))
+    assert(np.allclose(colors.loc['x', 'cat'], palette[1]))
+    assert(np.allclose(colors.loc['y', 'cat'], grey))
+
+
+@pytest.mark.skipif(miss_mpl, reason='No maplotlib available')
+def test_plot_group_abundance_changes(ds):
+    from scipy.interpolate import pchip_interpolate
+    ds2 = ds.copy()
+    ds2.samplesheet['time'] = [1, 2, 3, 2]
+    counts = pd.crosstab(
+            ds2.samplesheet['experiment'], ds2.samplesheet['time'])
+
+    fig, ax = plt.subplots()
+    ds2.plot.plot_group_abundance_changes(
+            'experiment', 'time',
+            ax=ax,
+            scatter_kwargs={},
+            interpolate_kwargs={},
+            )
+    plt.close(fig)
+    assert(len(ax.lines) == 0)
+    assert(len(ax.collections) == counts.shape[0])
+
+    fig, ax = plt.subplots()
+    ds2.plot.plot_group_abundance_changes(
+            'experiment', 'time',
+            ax=ax,
+            interpolate=True,
+            scatter_kwargs={},
+            interpolate_kwargs={},
+            )
+    plt.close(fig)
+    assert(len(ax.lines) == counts.shape[0])
+    x = np.arange(counts.shape[1])
+    for line, (_, row) in zip(ax.lines, counts.iterrows()):
+        outx = line.get_xdata()
+        assert(np.isclose(outx[0], x[0]) and np.isclose(outx[-1], x[-1]))
+        expected = pchip_interpolate(x, row.values, outx)
+        assert(np.allclose(line.get_ydata(), expected))
+
+
+def _dot_plot_expected(ds, group_by, plot_list, groups, color_log=None,
+                       vmin='min', vmax='max', threshold=10, min_size=2,
+                       layout='horizontal'):
+    pc = ds.counts.pseudocount
+    gcol = ds.samplesheet[group_by]
+    points = []
+    for ic, count in enumerate(plot_list):
+        if count in ds.counts.index:
+            values = ds.counts.loc[count]
+            clog = color_log is not False
+        else:
+            values = ds.samplesheet[count]
+            clog = bool(color_log)
+        for ig, gr in enumerate(groups):
+            v = values[gcol == gr].values.astype(float)
+            if len(v) == 0:
+                continue
+            level = np.log10(v + pc).mean() if clog else v.mean()
+            points.append((ic, ig, (v >= threshold).mean(), level))
+    ic, ig, fraction, level = [np.array(a) for a in zip(*points)]
+
+    if vmin == 'min_single':
+        vm = np.array([level[ic == i].min() for i in ic])
+    else:
+        vm = level.min()
+    if vmax == 'max_single':
+        vM = np.array([level[ic == i].max() for i in ic])
+    else:
+        vM = level.max()
+    if layout == 'horizontal':
+        xy = np.vstack([ic, ig]).T
+    else:
+        xy = np.vstack([ig, ic]).T
+    s = min_size + (fraction * 11)**2
+    c = matplotlib.cm.get_cmap('plasma')((level - vm) / (vM - vm))
+    return xy, s, c
+
+
+@pytest.mark.skipif(miss_mpl, reason='No maplotlib available')
+def test_dot_plot(ds):
+    ds2 = ds.copy()
+    ds2.samplesheet['pheno'] = [1.0, 4.0, 2.0, 3.0]
+    cases = [
+        {'color_log': None},
+        {'color_log': True, 'vmin': 'min_single', 'vmax': 'max_single'},
+        {'color_log': False, 'layout': 'vertical'},
+        {'color_log': None, 'vmin': 'min_single', 'layout': 'vertical'},
+        ]
+    plot_list = ['ACTB', 'TSPAN6', 'pheno']
+    groups = ['exp1', 'missing', 'test_pipeline']
+    for kwargs in cases:
+        fig, ax = plt.subplots()
+        ds2.plot.dot_plot(
+                group_by='experiment',
+                group_order=groups,
+                plot_list=plot_list,
+                threshold=300,
+                ax=ax,
+                **kwargs)
+        plt.close(fig)
+        xy, s, c = _dot_plot_expected(
+                ds2, 'experiment', plot_list, groups, threshold=300,
+                **kwargs)
+        coll = ax.collections[0]
+        assert(np.allclose(coll.get_offsets(), xy))
+        assert(np.allclose(coll.get_sizes(), s))
+        assert(np.allclose(coll.get_facecolors(), c))